@@ -1,30 +1,12 @@
 import argparse
+import mmap
 import os
 import struct
-from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import cv2
 import numpy as np
-
-class BitStream:
-    def __init__(self, stream):
-        self.stream = stream
-        self.buffer = 0
-        self.buffer_size = 0
-
-    def get_bits(self, num_bits):
-        while self.buffer_size < num_bits:
-            new_byte = self.stream.read(1)
-            if not new_byte:
-                raise EOFError("End of stream")
-            self.buffer = (self.buffer << 8) | ord(new_byte)
-            self.buffer_size += 8
-
-        result = self.buffer >> (self.buffer_size - num_bits)
-        self.buffer_size -= num_bits
-        self.buffer &= (1 << self.buffer_size) - 1  # Clear used bits
-        return result
-
-    def get_next_bit(self):
-        return self.get_bits(1)
+from numba import njit
 
 class GwdMetaData:
     def __init__(self, width, height, bpp, data_size):
@@ -33,8 +15,7 @@ class GwdMetaData:
         self.bpp = bpp
         self.data_size = data_size
 
-def read_metadata(stream):
-    header = stream.read(12)
+def read_metadata(header):
     if len(header) != 12:
         return None
     if header[4:7].decode('ascii') != 'GWD':
@@ -45,59 +26,127 @@ def read_metadata(stream):
     data_size = struct.unpack('<I', header[0:4])[0]
     return GwdMetaData(width, height, bpp, data_size)
 
-def unpack(stream, meta):
-    stream.seek(12)
+def unpack(buf, meta):
     width, height, bpp = meta.width, meta.height, meta.bpp
-    stride = width * bpp // 8
-    output = np.zeros((height, width, 3 if bpp == 24 else 1), dtype=np.uint8)
 
-    bit_stream = BitStream(stream)
+    alpha_offset = None
+    if bpp == 24:
+        offset = 4 + meta.data_size
+        if buf[offset:offset + 1] == b'\x01':
+            alpha_meta = read_metadata(buf[offset + 1:offset + 13])
+            if alpha_meta and alpha_meta.bpp == 8 and alpha_meta.width == width and alpha_meta.height == height:
+                alpha_offset = offset + 13
+
+    # Decode straight into the BGR(A) layout OpenCV writes, which is also the
+    # order the colour planes are stored in.
+    channels = 4 if alpha_offset is not None else (3 if bpp == 24 else 1)
+    output = np.zeros((height, width, channels), dtype=np.uint8)
+
+    # The colour and alpha images are decoded from offsets into the same buffer.
+    # Each layout has its own kernel so the plane loop is fixed at compile time.
+    data = np.frombuffer(buf, dtype=np.uint8)
     if bpp == 8:
-        for y in range(height):
-            output[y, :, 0] = fill_line(bit_stream, width)
+        _decode_bpp8(data[12:], width, height, output, DELTA_LUT)
+    elif bpp == 24:
+        _decode_bpp24(data[12:], width, height, output, DELTA_LUT)
     else:
-        for y in range(height):
-            for c in range(3):
-                line = fill_line(bit_stream, width)
-                output[y, :, c] = line
+        raise ValueError(f"Unsupported bpp: {bpp}")
 
-    if bpp == 24:
-        stream.seek(4 + meta.data_size)
-        if stream.read(1) == b'\x01':
-            alpha_meta = read_metadata(stream)
-            if alpha_meta and alpha_meta.bpp == 8 and alpha_meta.width == width and alpha_meta.height == height:
-                alpha_stream = BitStream(stream)
-                alpha_output = np.zeros((height, width), dtype=np.uint8)
-                for y in range(height):
-                    alpha_output[y, :] = fill_line(alpha_stream, width)
-                alpha_output = 255 - alpha_output  # Invert alpha channel
-                output = np.dstack((output, alpha_output))
+    if alpha_offset is not None:
+        _decode_alpha(data[alpha_offset:], width, height, output, DELTA_LUT)
+        np.subtract(255, output[:, :, 3], out=output[:, :, 3])  # Invert alpha channel in place
 
     return output
 
-def fill_line(bit_stream, width):
-    line = np.zeros(width, dtype=np.uint8)
+# Bit reader state is threaded through as (pos, buffer, buffer_size) so that
+# the whole decode stays inside compiled code.
+@njit(cache=True)
+def get_bits(data, pos, buffer, buffer_size, num_bits):
+    if buffer_size < num_bits:
+        # Top the buffer up to as many whole bytes as fit in 63 bits
+        refill = min((63 - buffer_size) >> 3, len(data) - pos)
+        for _ in range(refill):
+            buffer = (buffer << 8) | data[pos]
+            pos += 1
+        buffer_size += refill * 8
+        if buffer_size < num_bits:
+            raise EOFError("End of stream")
+
+    result = buffer >> (buffer_size - num_bits)
+    buffer_size -= num_bits
+    buffer &= (1 << buffer_size) - 1  # Clear used bits
+    return result, pos, buffer, buffer_size
+
+@njit(cache=True)
+def _decode_bpp8(data, width, height, out, lut):
+    pos, buffer, buffer_size = 0, 0, 0
+    for y in range(height):
+        pos, buffer, buffer_size = fill_line(data, pos, buffer, buffer_size, width, out[y, :, 0], lut)
+
+@njit(cache=True)
+def _decode_bpp24(data, width, height, out, lut):
+    pos, buffer, buffer_size = 0, 0, 0
+    for y in range(height):
+        for c in range(3):
+            pos, buffer, buffer_size = fill_line(data, pos, buffer, buffer_size, width, out[y, :, c], lut)
+
+@njit(cache=True)
+def _decode_alpha(data, width, height, out, lut):
+    pos, buffer, buffer_size = 0, 0, 0
+    for y in range(height):
+        pos, buffer, buffer_size = fill_line(data, pos, buffer, buffer_size, width, out[y, :, 3], lut)
+
+@njit(cache=True)
+def fill_line(data, pos, buffer, buffer_size, width, line, lut):
     dst = 0
     while dst < width:
-        length = bit_stream.get_bits(3)
-        if length == -1:
-            raise EOFError("End of stream")
-        count = get_count(bit_stream) + 1
+        length, pos, buffer, buffer_size = get_bits(data, pos, buffer, buffer_size, 3)
+        count, pos, buffer, buffer_size = get_count(data, pos, buffer, buffer_size)
+        count += 1
         if length != 0:
-            for _ in range(count):
-                line[dst] = bit_stream.get_bits(length + 1)
-                dst += 1
+            if dst + count > width:
+                raise IndexError("Line overflow")
+            # A literal run uses a fixed width, so read it straight from the bytes
+            bit_pos = pos * 8 - buffer_size
+            end = bit_pos + count * (length + 1)
+            if end > len(data) * 8:
+                raise EOFError("End of stream")
+            extract_run(data, bit_pos, count, length + 1, line, dst)
+            dst += count
+            pos, buffer, buffer_size = seek_bits(data, end)
         else:
             dst += count
 
     for i in range(1, width):
-        line[i] = delta_table(line[i], line[i-1])
-    return line
-
-# Precompute the delta table
-DELTA_TABLE = []
+        line[i] = lut[line[i], line[i-1]]
+    return pos, buffer, buffer_size
+
+@njit(cache=True)
+def extract_run(data, bit_pos, count, width_bits, line, dst):
+    mask = (1 << width_bits) - 1
+    last = len(data) - 1
+    for k in range(count):
+        b = bit_pos + k * width_bits
+        i = b >> 3
+        window = np.int64(data[i]) << 8
+        if i < last:
+            window |= data[i + 1]
+        line[dst + k] = (window >> (16 - width_bits - (b & 7))) & mask
+
+@njit(cache=True)
+def seek_bits(data, bit_pos):
+    pos = bit_pos >> 3
+    buffer, buffer_size = 0, 0
+    skip = bit_pos & 7
+    if skip:
+        buffer = data[pos] & ((1 << (8 - skip)) - 1)
+        buffer_size = 8 - skip
+        pos += 1
+    return pos, buffer, buffer_size
+
+# Precompute the delta table, indexed as [curr, prev]
+DELTA_LUT = np.zeros((256, 256), dtype=np.uint8)
 for j in range(256):
-    row = []
     for i in range(256):
         prev = i if i < 128 else 255 - i
         if 2 * prev < j:
@@ -106,53 +155,63 @@ for j in range(256):
             v = prev + ((j + 1) >> 1)
         else:
             v = prev - (j >> 1)
-        row.append(v if i < 128 else 255 - v)
-    DELTA_TABLE.append(row)
-
-def delta_table(curr, prev):
-    return DELTA_TABLE[curr][prev]
+        DELTA_LUT[j, i] = v if i < 128 else 255 - v
 
-def get_count(bit_stream):
+@njit(cache=True)
+def get_count(data, pos, buffer, buffer_size):
     n = 1
-    while bit_stream.get_next_bit() == 0:
+    while True:
+        bit, pos, buffer, buffer_size = get_bits(data, pos, buffer, buffer_size, 1)
+        if bit != 0:
+            break
         n += 1
-    return bit_stream.get_bits(n) + (1 << n) - 2
+    value, pos, buffer, buffer_size = get_bits(data, pos, buffer, buffer_size, n)
+    return value + (1 << n) - 2, pos, buffer, buffer_size
 
 def save_image(image_data, width, height, bpp, output_file):
-    if image_data.shape[2] == 4:
-        image_data = image_data[:, :, [2, 1, 0, 3]]  # Convert BGRA to RGBA
-        image = Image.fromarray(image_data, 'RGBA')
-    else:
-        if bpp == 24:
-            image_data = image_data[:, :, ::-1]  # Convert BGR to RGB
-            image = Image.fromarray(image_data, 'RGB')
-        else:
-            image = Image.fromarray(image_data.reshape((height, width)), 'L')
-
-    image.save(output_file)
+    if image_data.shape[2] == 1:
+        image_data = image_data.reshape((height, width))
+
+    # image_data is already BGR(A), so OpenCV can encode it without a copy
+    ok, encoded = cv2.imencode('.png', image_data, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    if not ok:
+        raise IOError(f"Failed to encode {output_file}")
+    encoded.tofile(output_file)  # Unlike cv2.imwrite, handles non-ASCII paths
+
+def convert_file(filename, input_dir, output_dir):
+    input_file = os.path.join(input_dir, filename)
+    output_file = os.path.join(output_dir, os.path.splitext(filename)[0] + '.png')
+
+    try:
+        with open(input_file, 'rb') as stream:
+            if os.fstat(stream.fileno()).st_size < 12:
+                print(f"Invalid GWD file: {filename}")
+                return
+
+            # Map the file so the decoder can index it directly. The map is
+            # released with the last array viewing it rather than closed here,
+            # since an error traceback may still reference those views.
+            mm = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+            meta = read_metadata(mm[:12])
+            if not meta:
+                print(f"Invalid GWD file: {filename}")
+                return
+
+            image_data = unpack(mm, meta)
+            print(f"Saving image with width={meta.width}, height={meta.height}, bpp={meta.bpp}")
+            save_image(image_data, meta.width, meta.height, meta.bpp, output_file)
+            print(f"Converted {filename} to {output_file}")
+    except Exception as e:
+        print(f"Error processing {filename}: {e}")
 
 def process_directory(input_dir, output_dir):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    for filename in os.listdir(input_dir):
-        if filename.endswith('.gwd'):
-            input_file = os.path.join(input_dir, filename)
-            output_file = os.path.join(output_dir, os.path.splitext(filename)[0] + '.png')
-
-            try:
-                with open(input_file, 'rb') as stream:
-                    meta = read_metadata(stream)
-                    if not meta:
-                        print(f"Invalid GWD file: {filename}")
-                        continue
-
-                    image_data = unpack(stream, meta)
-                    print(f"Saving image with width={meta.width}, height={meta.height}, bpp={meta.bpp}")
-                    save_image(image_data, meta.width, meta.height, meta.bpp, output_file)
-                    print(f"Converted {filename} to {output_file}")
-            except Exception as e:
-                print(f"Error processing {filename}: {e}")
+    # Files are independent, so convert them in parallel across processes
+    filenames = [f for f in os.listdir(input_dir) if f.endswith('.gwd')]
+    with ProcessPoolExecutor() as executor:
+        list(executor.map(convert_file, filenames, repeat(input_dir), repeat(output_dir)))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Convert GWD images to PNG")
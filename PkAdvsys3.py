@@ -3,31 +3,41 @@ import struct
 import argparse
 import json
 
+_HDR = struct.Struct('<IIH').pack
+
 class ArcPacker:
     def __init__(self, output_file):
         self.output_file = output_file
-        self.entries = []
+        # Write to a temporary file so a failed pack never touches the existing archive
+        self.temp_file = output_file + '.tmp'
+        self.f = open(self.temp_file, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Only reached with the file still open if write_archive never ran
+        if not self.f.closed:
+            self.f.close()
+            os.remove(self.temp_file)
 
     def add_entry(self, name, data, counter):
         size = len(data)
-        entry = struct.pack('<I', size)  # pack size as uint32 little endian
-        entry += struct.pack('<I', counter)  # pack the counter as uint32 little endian
-        entry += struct.pack('<H', len(name))  # pack name length as uint16 little endian
-        entry += name.encode('utf-8')  # encode name as utf-8
-        entry += data
-        self.entries.append(entry)
+        # size and counter as uint32, name length as uint16, all little endian
+        header = _HDR(size, counter, len(name))
+        header += name.encode('utf-8')  # encode name as utf-8
+        # Stream each entry straight to the archive instead of holding it in memory
+        self.f.write(header)
+        self.f.write(data)
 
     def write_archive(self):
-        with open(self.output_file, 'wb') as f:
-            for entry in self.entries:
-                f.write(entry)
-            # Add 4 bytes indicating end of archive
-            f.write(b'\x00\x00\x00\x00')
+        # Add 4 bytes indicating end of archive
+        self.f.write(b'\x00\x00\x00\x00')
+        self.f.close()
+        os.replace(self.temp_file, self.output_file)
         print(f"Archive '{self.output_file}' created successfully.")
 
 def pack_directory(input_dir, output_file, order_file):
-    packer = ArcPacker(output_file)
-    
     with open(order_file, 'r') as json_file:
         order_data = json.load(json_file)
 
@@ -35,28 +45,29 @@ def pack_directory(input_dir, output_file, order_file):
    # counter = 100000 remove the # to pack arca.dat
     special_file_found = False
     
-    for i, entry in enumerate(order_data):
-        file_name = entry['name']
-        file_path = os.path.join(input_dir, file_name)
-        
-        with open(file_path, 'rb') as f:
-            data = f.read()
-        
-        # Remove the file extension
-        file_name_no_ext = os.path.splitext(file_name)[0]
-        
-        if file_name == "system_setup_ss":
-            counter = 1000
-            special_file_found = True
-        
-        packer.add_entry(file_name_no_ext, data, counter)
-        
-        if special_file_found:
-            counter += 1
-        else:
-            counter += 1  # Increment counter by 1 for each file
+    with ArcPacker(output_file) as packer:
+        for i, entry in enumerate(order_data):
+            file_name = entry['name']
+            file_path = os.path.join(input_dir, file_name)
+            
+            with open(file_path, 'rb') as f:
+                data = f.read()
+            
+            # Remove the file extension
+            file_name_no_ext = os.path.splitext(file_name)[0]
+            
+            if file_name == "system_setup_ss":
+                counter = 1000
+                special_file_found = True
+            
+            packer.add_entry(file_name_no_ext, data, counter)
+            
+            if special_file_found:
+                counter += 1
+            else:
+                counter += 1  # Increment counter by 1 for each file
 
-    packer.write_archive()
+        packer.write_archive()
 
 def main():
     parser = argparse.ArgumentParser(description='Pack files in a directory into an AdvSys3 engine resource archive based on a specified order in a JSON file.')
@@ -1,30 +1,11 @@
 import argparse
 import os
 import struct
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from PIL import Image
 import numpy as np
-
-class BitStreamWriter:
-    def __init__(self, stream):
-        self.stream = stream
-        self.buffer = 0
-        self.buffer_size = 0
-
-    def write_bits(self, value, num_bits):
-        self.buffer = (self.buffer << num_bits) | value
-        self.buffer_size += num_bits
-
-        while self.buffer_size >= 8:
-            self.buffer_size -= 8
-            byte = (self.buffer >> self.buffer_size) & 0xFF
-            self.stream.write(bytes([byte]))
-
-    def flush(self):
-        if self.buffer_size > 0:
-            byte = (self.buffer << (8 - self.buffer_size)) & 0xFF
-            self.stream.write(bytes([byte]))
-            self.buffer = 0
-            self.buffer_size = 0
+from numba import njit
 
 def write_metadata(stream, width, height, bpp, data_size):
     header = struct.pack('<I', data_size)
@@ -32,94 +13,119 @@ def write_metadata(stream, width, height, bpp, data_size):
     header += struct.pack('>HHB', width, height, bpp)
     stream.write(header)
 
-def pack(stream, image_data, width, height, bpp):
-    bit_stream = BitStreamWriter(stream)
-
+def pack(image_data, width, height, bpp):
+    nplanes = 3 if bpp == 24 else 1
+    # Encode from contiguous (plane, height, width) images, matching the file layout
+    planes = np.ascontiguousarray(image_data.transpose(2, 0, 1))
+    # Worst case is a literal of 3 + 8 bits for every pixel of every plane
+    out = np.empty(height * width * nplanes * 2 + 1, dtype=np.uint8)
+    size = encode_planes(planes, width, height, nplanes, out, ENCODE_LUT, BITLEN_LUT)
+    return out[:size]
+
+# Bit writer state is threaded through as (out_pos, acc, acc_size) so that
+# the whole encode stays inside compiled code.
+@njit(cache=True)
+def write_bits(out, out_pos, acc, acc_size, value, num_bits):
+    acc = (acc << num_bits) | (value & ((1 << num_bits) - 1))
+    acc_size += num_bits
+
+    while acc_size >= 8:
+        acc_size -= 8
+        out[out_pos] = (acc >> acc_size) & 0xFF
+        out_pos += 1
+    acc &= (1 << acc_size) - 1
+    return out_pos, acc, acc_size
+
+@njit(cache=True)
+def encode_planes(planes, width, height, nplanes, out, encode_lut, bitlen_lut):
+    out_pos, acc, acc_size = 0, 0, 0
+    encoded_line = np.empty(width, dtype=np.uint8)
     for y in range(height):
-        for c in range(3 if bpp == 24 else 1):
-            line = image_data[y, :, c]
-            encoded_line = delta_encode_line(line)
-            write_line(bit_stream, encoded_line)
-
-    bit_stream.flush()
-
-def delta_encode_line(line):
-    encoded_line = np.zeros_like(line)
-    encoded_line[0] = line[0]
+        for c in range(nplanes):
+            delta_encode_line(planes[c, y], encoded_line, encode_lut)
+            out_pos, acc, acc_size = write_line(out, out_pos, acc, acc_size, encoded_line, bitlen_lut)
+
+    if acc_size > 0:
+        out[out_pos] = (acc << (8 - acc_size)) & 0xFF
+        out_pos += 1
+    return out_pos
+
+# Precompute the delta encoding table, indexed as [curr, prev]
+ENCODE_LUT = np.zeros((256, 256), dtype=np.uint8)
+for curr in range(256):
+    for i in range(256):
+        prev = i if i < 128 else 255 - i
+        if 2 * prev < curr:
+            v = curr
+        elif curr & 1:
+            v = prev + ((curr + 1) >> 1)
+        else:
+            v = prev - (curr >> 1)
+        ENCODE_LUT[curr, i] = v if prev < 128 else 255 - v
 
+@njit(cache=True)
+def delta_encode_line(line, out, lut):
+    out[0] = line[0]
     for i in range(1, len(line)):
-        encoded_line[i] = encode_delta(line[i], line[i - 1])
-
-    return encoded_line
+        out[i] = lut[line[i], line[i - 1]]
 
-def encode_delta(curr, prev):
-    prev = prev if prev < 128 else 255 - prev
-    if 2 * prev < curr:
-        v = curr
-    elif curr & 1:
-        v = prev + ((curr + 1) >> 1)
-    else:
-        v = prev - (curr >> 1)
-    return v if prev < 128 else 255 - v
+# Index of the highest set bit for each byte value; 0 maps to 0
+BITLEN_LUT = np.array([max(v.bit_length() - 1, 0) for v in range(256)], dtype=np.uint8)
 
-def write_line(bit_stream, line):
+@njit(cache=True)
+def write_line(out, out_pos, acc, acc_size, line, bitlen_lut):
     width = len(line)
     dst = 0
     while dst < width:
-        count = get_run_length(line, dst)
+        count = 1
+        while dst + count < width and line[dst + count] == line[dst] and count < 255:
+            count += 1
         if count > 1:
-            bit_stream.write_bits(0, 3)  # length = 0 for runs
-            write_count(bit_stream, count - 1)
-            dst += count
+            out_pos, acc, acc_size = write_bits(out, out_pos, acc, acc_size, 0, 3)  # length = 0 for runs
+            out_pos, acc, acc_size = write_count(out, out_pos, acc, acc_size, count - 1)
         else:
-            bit_length = get_bit_length(line[dst])
-            bit_stream.write_bits(bit_length, 3)
-            bit_stream.write_bits(line[dst], bit_length + 1)
-            dst += 1
-
-def get_run_length(line, pos):
-    length = 1
-    while pos + length < len(line) and line[pos] == line[pos + length] and length < 255:
-        length += 1
-    return length
-
-def get_bit_length(value):
-    length = 0
-    while value > 0:
-        value >>= 1
-        length += 1
-    return length - 1
-
-def write_count(bit_stream, count):
+            bit_length = np.int64(bitlen_lut[line[dst]])
+            out_pos, acc, acc_size = write_bits(out, out_pos, acc, acc_size, bit_length, 3)
+            out_pos, acc, acc_size = write_bits(out, out_pos, acc, acc_size, np.int64(line[dst]), bit_length + 1)
+        dst += count
+    return out_pos, acc, acc_size
+
+@njit(cache=True)
+def write_count(out, out_pos, acc, acc_size, count):
     n = 1
     while count > (1 << n) - 2:
         n += 1
-    bit_stream.write_bits(n - 1, 3)  # 3-bit count
-    bit_stream.write_bits(count - ((1 << n) - 2), n)
+    out_pos, acc, acc_size = write_bits(out, out_pos, acc, acc_size, n - 1, 3)  # 3-bit count
+    return write_bits(out, out_pos, acc, acc_size, count - ((1 << n) - 2), n)
+
+def convert_file(filename, input_dir, output_dir):
+    input_file = os.path.join(input_dir, filename)
+    output_file = os.path.join(output_dir, os.path.splitext(filename)[0] + '.gwd')
+
+    try:
+        with Image.open(input_file) as img:
+            img = img.convert('RGB')
+            image_data = np.array(img)
+            height, width, _ = image_data.shape
+            bpp = 24
+            packed = pack(image_data, width, height, bpp)
+            data_size = 8 + len(packed)  # GWD header plus packed data
+
+            with open(output_file, 'wb') as stream:
+                write_metadata(stream, width, height, bpp, data_size)
+                stream.write(packed)
+                print(f"Converted {filename} to {output_file}")
+    except Exception as e:
+        print(f"Error processing {filename}: {e}")
 
 def process_directory(input_dir, output_dir):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    for filename in os.listdir(input_dir):
-        if filename.endswith('.png'):
-            input_file = os.path.join(input_dir, filename)
-            output_file = os.path.join(output_dir, os.path.splitext(filename)[0] + '.gwd')
-
-            try:
-                with Image.open(input_file) as img:
-                    img = img.convert('RGB')
-                    image_data = np.array(img)
-                    height, width, _ = image_data.shape
-                    bpp = 24
-                    data_size = height * width * (bpp // 8)
-
-                    with open(output_file, 'wb') as stream:
-                        write_metadata(stream, width, height, bpp, data_size)
-                        pack(stream, image_data, width, height, bpp)
-                        print(f"Converted {filename} to {output_file}")
-            except Exception as e:
-                print(f"Error processing {filename}: {e}")
+    # Files are independent, so convert them in parallel across processes
+    filenames = [f for f in os.listdir(input_dir) if f.endswith('.png')]
+    with ProcessPoolExecutor() as executor:
+        list(executor.map(convert_file, filenames, repeat(input_dir), repeat(output_dir)))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Convert PNG images to GWD")